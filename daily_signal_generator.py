@@ -1,13 +1,20 @@
 import requests
 import time
 import datetime
+import statistics
 import os
+import sys
+import fcntl
 import json
-import matplotlib.pyplot as plt
+import orjson
+import hashlib
+import functools
 from io import BytesIO
 import yfinance as yf
-import openai
 import traceback
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 
 # ---------- 환경 변수 및 초기 설정 ----------
 BOT_TOKEN = os.getenv("TELEGRAM_TOKEN")
@@ -17,28 +24,95 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 if not BOT_TOKEN or not CHAT_ID:
     raise EnvironmentError("FATAL ERROR: TELEGRAM_TOKEN or TELEGRAM_TO is not set in environment.")
 
-try:
-    openai_client = openai.OpenAI(api_key=OPENAI_API_KEY)
-except Exception:
-    openai_client = None
+OPENAI_CHAT_URL = "https://api.openai.com/v1/chat/completions"
+OPENAI_TIMEOUT = (3, 15)  # (connect, read) 초
+
+# 텔레그램/OpenAI 공용 세션 (keep-alive로 TCP/TLS 핸드셰이크 재사용, 일시적 5xx는 재시도)
+HTTP_TIMEOUT = (3, 10)  # (connect, read) 초
+# 연결 실패와 502/503/504 응답만 재시도. 읽기 타임아웃/응답 유실은 이미 전달됐을 수 있어 재전송하지 않음(read=0)
+# 최악의 경우 한 번의 호출 = 4회 x (3+10)초 + 백오프(0.6+1.2)초 ≈ 54초
+_RETRY = Retry(total=3, connect=3, read=0, status=3, backoff_factor=0.3,
+               status_forcelist=[502, 503, 504], allowed_methods=["POST", "GET"])
+_HTTP_SESSION = requests.Session()
+_HTTP_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=_RETRY))
+_HTTP_SESSION.headers.update({"Connection": "keep-alive"})
+
+# OpenAI는 읽기 타임아웃이 길어 재시도를 1회로 제한. 최악의 경우 2회 x (3+15)초 ≈ 36초
+_OPENAI_RETRY = Retry(total=1, connect=1, read=0, status=1, backoff_factor=0.3,
+                      status_forcelist=[502, 503, 504], allowed_methods=["POST"])
+_HTTP_SESSION.mount("https://api.openai.com/", HTTPAdapter(max_retries=_OPENAI_RETRY))
+
+TELEGRAM_CAPTION_LIMIT = 1024  # sendPhoto 캡션 최대 길이
 
 DATA_FILE = "gold_premium_history.json"
 TROY_Ounce_TO_GRAM = 31.1035 
 
+# 시세 캐시 (재실행/중복 실행 시 불필요한 조회 생략)
+CACHE_DIR = ".cache"
+CACHE_TTL = 300  # 초
+_ticker_cache = {}
+
+_KST = datetime.timezone(datetime.timedelta(hours=9))
+
 # ---------- 헬퍼 함수 ----------
 def timestamp_to_kst(timestamp):
     if timestamp is None:
         return "N/A"
-    dt_object = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
-    kst_tz = datetime.timezone(datetime.timedelta(hours=9))
-    kst_dt = dt_object.astimezone(kst_tz)
-    return kst_dt.strftime('%Y-%m-%d %H:%M:%S KST')
+    return datetime.datetime.fromtimestamp(timestamp, _KST).strftime('%Y-%m-%d %H:%M:%S KST')
+
+class FileCache:
+    """`.cache/{key}.json`에 {ts, payload} 형태로 저장하는 단순 파일 캐시"""
+    def __init__(self, directory=CACHE_DIR, ttl=CACHE_TTL):
+        self.directory = directory
+        self.ttl = ttl
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "r") as f:
+                entry = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        if time.time() - entry.get("ts", 0) >= self.ttl:
+            return None
+        return entry.get("payload")
+
+    def set(self, key, payload):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self._path(key), "w") as f:
+                json.dump({"ts": time.time(), "payload": payload}, f)
+        except OSError:
+            pass  # 캐시 저장 실패는 무시
+
+_file_cache = FileCache()
+
+def cached(func):
+    """메모리(_ticker_cache) -> 파일 캐시 -> 실제 조회 순으로 결과를 찾는 데코레이터"""
+    @functools.wraps(func)
+    def wrapper(*args):
+        key = hashlib.md5(f"{func.__name__}:{args!r}".encode()).hexdigest()
+        if key in _ticker_cache:
+            return _ticker_cache[key]
+
+        payload = _file_cache.get(key)
+        if payload is not None:
+            result = tuple(payload)
+        else:
+            result = func(*args)
+            _file_cache.set(key, list(result))
+
+        _ticker_cache[key] = result
+        return result
+    return wrapper
 
 def send_telegram_text(msg):
     url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
     payload = {"chat_id": CHAT_ID, "text": msg}
     try:
-        r = requests.post(url, json=payload, timeout=10)
+        r = _HTTP_SESSION.post(url, json=payload, timeout=HTTP_TIMEOUT)
         r.raise_for_status()
     except requests.exceptions.RequestException as e:
         raise RuntimeError(f"텔레그램 메시지 발송 실패: {e}")
@@ -46,14 +120,16 @@ def send_telegram_text(msg):
 def send_telegram_photo(image_bytes, caption=""):
     files = {"photo": image_bytes}
     data = {"chat_id": CHAT_ID, "caption": caption}
-    response = requests.post(f"https://api.telegram.org/bot{BOT_TOKEN}/sendPhoto", files=files, data=data, timeout=10)
+    response = _HTTP_SESSION.post(f"https://api.telegram.org/bot{BOT_TOKEN}/sendPhoto", files=files, data=data, timeout=HTTP_TIMEOUT)
     response.raise_for_status()
 
 # 1. 국내 금 ETF 데이터 (현재가, 전일종가, NAV)
+@cached
 def get_korean_gold_data():
     symbol = "411060.KS"  
     try:
         ticker = yf.Ticker(symbol)
+        # navPrice는 fast_info에 없으므로 이 종목만 .info 조회 유지
         data = ticker.info
         
         market_price = data.get('regularMarketPrice')
@@ -71,28 +147,38 @@ def get_korean_gold_data():
     except Exception as e:
         raise RuntimeError(f"KRX 골드 ETF 조회 실패: {type(e).__name__} - {e}")
 
-# 2. Yahoo Finance 가격 조회 (현재가, 전일종가 반환)
-def get_yahoo_price_pair(symbol):
+# 2. Yahoo Finance 가격 일괄 조회 (심볼별 (현재가, 전일종가) 반환)
+@cached
+def get_yahoo_price_pairs(symbols):
     try:
-        ticker = yf.Ticker(symbol)
-        data = ticker.info
-        price = data.get('regularMarketPrice')
-        prev = data.get('previousClose')
-        
-        if price is None: price = prev
-        if price is None:
-            raise ValueError(f"Yahoo Finance: '{symbol}' 데이터 누락.")
-            
-        return price, prev
+        # 심볼별 일봉 history 요청을 yf.download가 스레드로 병렬 실행 (휴장일 대비 5일치)
+        df = yf.download(list(symbols), period="5d", interval="1d",
+                         group_by="ticker", progress=False, threads=True)
+        pairs = []
+        for symbol in symbols:
+            closes = df[symbol]["Close"].dropna()
+            if closes.empty:
+                raise ValueError(f"Yahoo Finance: '{symbol}' 데이터 누락.")
+
+            price = float(closes.iloc[-1])
+            # 전일종가는 Yahoo의 previousClose 사용. 당일 일봉이 아직 없는 시간대(08:00 KST 등)에는
+            # closes.iloc[-2]가 이틀 전 종가가 되어 NAV 추정 비율이 틀어짐
+            prev = yf.Ticker(symbol).fast_info.previous_close
+            pairs.append((price, prev))
+
+        return tuple(pairs)
     except Exception as e:
-        raise RuntimeError(f"Yahoo Finance '{symbol}' 조회 실패: {type(e).__name__} - {e}")
+        raise RuntimeError(f"Yahoo Finance {list(symbols)} 조회 실패: {type(e).__name__} - {e}")
 
 # 3. 모든 데이터 가져오기
 def get_gold_and_fx_data():
-    usd_krw, usd_krw_prev = get_yahoo_price_pair("USDKRW=X")
-    gold_usd, gold_usd_prev = get_yahoo_price_pair("GC=F")
-    
-    etf_price, etf_prev, etf_nav, etf_time = get_korean_gold_data()
+    # 환율/금 선물 일괄 조회와 ETF(NAV) 조회는 독립적이므로 동시에 실행
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        f_pairs = ex.submit(get_yahoo_price_pairs, ("USDKRW=X", "GC=F"))
+        f_etf = ex.submit(get_korean_gold_data)
+
+        (usd_krw, usd_krw_prev), (gold_usd, gold_usd_prev) = f_pairs.result()
+        etf_price, etf_prev, etf_nav, etf_time = f_etf.result()
     
     return {
         "etf_now": etf_price,
@@ -109,16 +195,29 @@ def get_gold_and_fx_data():
 def load_history():
     if os.path.exists(DATA_FILE):
         try:
-            with open(DATA_FILE, "r") as f:
-                return json.load(f)
-        except json.JSONDecodeError:
+            with open(DATA_FILE, "rb") as f:
+                return orjson.loads(f.read())
+        except orjson.JSONDecodeError:
             return []
     return []
 
 def save_history(data):
     data = data[-100:]
-    with open(DATA_FILE, "w") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    new_bytes = orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+
+    # 내용이 바뀌지 않았으면 다시 쓰지 않음
+    try:
+        with open(DATA_FILE, "rb") as f:
+            if f.read() == new_bytes:
+                return
+    except OSError:
+        pass
+
+    # 임시 파일에 쓴 뒤 교체하여 중간에 깨진 파일이 남지 않도록 함
+    tmp_path = DATA_FILE + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(new_bytes)
+    os.replace(tmp_path, DATA_FILE)
 
 # (핵심) calc_premium: NAV 누락 시 '동적 비율'로 추정 NAV 계산
 def calc_premium():
@@ -178,27 +277,37 @@ def create_graph(history):
     dates = [x["date"] for x in history]
     premiums = [x["premium"] for x in history]
 
-    plt.figure(figsize=(6, 3))
-    plt.plot(dates, premiums, marker="o")
-    plt.title("ETF Premium Trend (%)")
-    plt.ylabel("Premium (%)")
-    plt.xticks(rotation=45, ha='right')
-    plt.grid(True, alpha=0.3)
-    plt.tight_layout()
+    # 그래프가 필요할 때만 로드. pyplot 전역 상태 없이 그려 작업 스레드에서도 안전
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=(6, 3))
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
+    ax.plot(dates, premiums, marker="o")
+    ax.set_title("ETF Premium Trend (%)")
+    ax.set_ylabel("Premium (%)")
+    ax.tick_params(axis="x", labelrotation=45)
+    for label in ax.get_xticklabels():
+        label.set_horizontalalignment("right")
+    ax.grid(True, alpha=0.3)
+    fig.tight_layout()
 
     buf = BytesIO()
-    plt.savefig(buf, format="png")
-    plt.close()
+    fig.savefig(buf, format="png")
     buf.seek(0)
     return buf
 
 def analyze_with_ai(today_msg, history):
-    if not openai_client:
-        return "AI 분석 오류: OpenAI 클라이언트 초기화 실패"
+    if not OPENAI_API_KEY:
+        return "AI 분석 오류: OPENAI_API_KEY가 설정되지 않음"
     
+    # 토큰 절약: 필요한 필드(날짜, 괴리율)만 짧은 키로 압축해서 전달
+    recent = [{"d": x["date"], "p": x["premium"]} for x in history[-7:]]
+
     prompt = f"""
-다음은 최근 7일간의 ACE KRX금현물 ETF 괴리율 데이터입니다.
-{json.dumps(history[-7:], ensure_ascii=False, indent=2)}
+다음은 최근 7일간의 ACE KRX금현물 ETF 괴리율 데이터입니다. (d: 날짜, p: 괴리율 %)
+{orjson.dumps(recent).decode()}
 
 오늘의 주요 데이터:
 {today_msg}
@@ -206,17 +315,31 @@ def analyze_with_ai(today_msg, history):
 이 데이터를 기반으로 괴리율(프리미엄) 상태와 투자 관점 요약을 3줄 이내로 설명해줘.
 """
     try:
-        response = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.6,
+        r = _HTTP_SESSION.post(
+            OPENAI_CHAT_URL,
+            headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
+            json={
+                "model": "gpt-4o-mini",
+                "messages": [{"role": "user", "content": prompt}],
+                "temperature": 0.6,
+            },
+            timeout=OPENAI_TIMEOUT,
         )
-        return response.choices[0].message.content.strip()
+        r.raise_for_status()
+        return r.json()["choices"][0]["message"]["content"].strip()
     except Exception as e:
         return f"AI 분석 오류: {e}"
 
 def main():
     try:
+        # 중복 실행(cron 이중 트리거 등) 방지: 이미 실행 중이면 조용히 종료
+        lock_fd = os.open(DATA_FILE + ".lock", os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print("이미 실행 중인 인스턴스가 있어 종료합니다.")
+            sys.exit(0)
+
         today = datetime.date.today().isoformat()
         
         # 변수 초기화
@@ -253,12 +376,11 @@ def main():
         save_history(history)
 
         # 통계 계산
-        prev_premium_data = [h for h in history if h["date"] != today]
-        prev = prev_premium_data[-1]["premium"] if prev_premium_data else info["premium"]
+        # history는 날짜순으로 쌓이고 마지막 항목이 항상 오늘이므로 바로 앞 항목이 전일
+        prev = history[-2]["premium"] if len(history) >= 2 else info["premium"]
         change = info["premium"] - prev
         
-        last7 = [x["premium"] for x in history[-7:]]
-        avg7 = sum(last7)/len(last7) if last7 else 0
+        avg7 = statistics.fmean(x["premium"] for x in history[-7:])
         level = "고평가" if info["premium"] > avg7 else "저평가"
         trend = "📈 상승세" if change > 0 else "📉 하락세"
             
@@ -275,14 +397,40 @@ def main():
             f"최근 7일 평균({avg7:.2f}%) 대비: {level} {trend}"
         )
         
-        ai_summary = analyze_with_ai(msg_data, history)
-        full_msg = f"{msg_data}\n\n🤖 AI 요약:\n{ai_summary}"
+        # AI 요약(네트워크)과 그래프 렌더링은 독립적이므로 동시에 실행
+        with ThreadPoolExecutor(max_workers=2) as ex:
+            f_ai = ex.submit(analyze_with_ai, msg_data, history)
+            # 데이터가 2개 미만이면 그래프(및 matplotlib 로드) 자체를 생략
+            f_graph = ex.submit(create_graph, history) if len(history) >= 2 else None
 
-        send_telegram_text(full_msg)
+            ai_summary = f_ai.result()
 
-        graph_buf = create_graph(history)
-        if graph_buf:
-            send_telegram_photo(graph_buf, caption="📈 괴리율 추세")
+            # 그래프 실패로 본문 리포트까지 잃지 않도록 그래프 없이 계속 진행
+            graph_buf = None
+            if f_graph:
+                try:
+                    graph_buf = f_graph.result()
+                except Exception as e:
+                    print(f"그래프 생성 실패: {type(e).__name__} - {e}")
+
+        full_msg = f"{msg_data}\n\n🤖 AI 요약:\n{ai_summary}"
+
+        # 캡션 한도(텔레그램은 UTF-16 코드 단위로 셈) 이내면 그래프 + 본문을 한 번의 sendPhoto로 발송
+        if graph_buf and len(full_msg.encode("utf-16-le")) // 2 <= TELEGRAM_CAPTION_LIMIT:
+            try:
+                send_telegram_photo(graph_buf, caption=full_msg)
+            except requests.exceptions.HTTPError as e:
+                # 캡션이 거부된 경우(400)만 나눠서 재발송. 타임아웃 등은 이미 전달됐을 수 있어 재전송하지 않음
+                if e.response is None or e.response.status_code != 400:
+                    raise
+                print(f"캡션 사진 발송 거부, 텍스트와 그래프로 나눠 발송: {e}")
+                send_telegram_text(full_msg)
+                graph_buf.seek(0)
+                send_telegram_photo(graph_buf, caption="📈 괴리율 추세")
+        else:
+            send_telegram_text(full_msg)
+            if graph_buf:
+                send_telegram_photo(graph_buf, caption="📈 괴리율 추세")
 
     except Exception as e:
         error_msg = f"🔥 오류 발생: {type(e).__name__} - {e}\n{traceback.format_exc()}"